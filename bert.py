@@ -307,6 +307,28 @@ class BertSelfAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
+        if (
+            not output_attentions
+            and head_mask is None
+            and decoder_relative_position_mask is None
+            and self.position_embedding_type == "absolute"
+            and hasattr(nn.functional, "scaled_dot_product_attention")
+        ):
+            # fused flash/memory-efficient attention; attention_mask is the
+            # additive extended mask precomputed in BertModel.forward
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(*new_context_layer_shape)
+            outputs = (context_layer,)
+            if self.is_decoder:
+                outputs = outputs + (past_key_value,)
+            return outputs
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import math
 import os
@@ -16,14 +17,64 @@ from bert import BertModel, BertOnlyMLMHead
 
 def select_worst_as_mask(token_probs, num_mask):
     bsz, seq_len = token_probs.size()
-    masks = [token_probs[batch, :].topk(max(1, num_mask[batch]), largest=False, sorted=False)[1] for batch in range(bsz)]
-    masks = [torch.cat([mask, mask.new(seq_len - mask.size(0)).fill_(mask[0])], dim=0) for mask in masks]
-    return torch.stack(masks, dim=0)
+    num_mask = num_mask.clamp(min=1)
+    k = int(num_mask.max())
+    # sorted=True: rows with num_mask[b] < k keep a prefix of this result,
+    # which must be the num_mask[b] worst, not an arbitrary subset of the k worst
+    _, masks = token_probs.topk(k, dim=1, largest=False, sorted=True)
+    # positions beyond each example's own num_mask repeat its first index,
+    # matching the per-example fill_(mask[0]) padding of the old loop
+    fill = masks[:, :1]
+    arange = torch.arange(k, device=masks.device).unsqueeze(0)
+    masks = torch.where(arange < num_mask.view(-1, 1), masks, fill)
+    if k < seq_len:
+        masks = torch.cat([masks, fill.expand(bsz, seq_len - k)], dim=1)
+    return masks
 
 def assign_single_value_long(x, i, y):
-    b, l = x.size()
-    i = i + torch.arange(0, b*l, l, device=i.device).unsqueeze(1)
-    x.view(-1)[i.view(-1)] = y
+    x.scatter_(1, i, y)
+
+_base_position_cache = {}
+
+def _base_positions(max_len, dtype, device):
+    # grow-only per-(dtype, device) arange buffer; callers only read from it,
+    # so slicing a shared buffer is safe and avoids a fresh allocation per call
+    key = (dtype, device)
+    buf = _base_position_cache.get(key)
+    if buf is None or buf.numel() < max_len:
+        buf = torch.arange(0, max_len, dtype=dtype, device=device)
+        _base_position_cache[key] = buf
+    return buf[:max_len]
+
+def swap_linears_for_fp8(module, te):
+    # replace every nn.Linear in the BERT trunk with a te.Linear of the same
+    # shape; te.Linear runs its GEMMs in FP8 under te.fp8_autocast
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            fp8_linear = te.Linear(child.in_features, child.out_features,
+                                   bias=child.bias is not None)
+            with torch.no_grad():
+                fp8_linear.weight.copy_(child.weight)
+                if child.bias is not None:
+                    fp8_linear.bias.copy_(child.bias)
+            setattr(module, name, fp8_linear)
+        else:
+            swap_linears_for_fp8(child, te)
+
+def _length_pool(enc_feats, src_masks, weight):
+    src_masks = src_masks.type_as(enc_feats)
+    # masked mean over T as one bmm reduction instead of the
+    # transpose / broadcast-divide / broadcast-multiply chain
+    enc_feats = torch.bmm(src_masks.unsqueeze(1), enc_feats).squeeze(1) \
+        / src_masks.sum(1, keepdim=True)
+    return F.log_softmax(F.linear(enc_feats, weight), -1)
+
+if hasattr(torch, 'compile'):
+    # fuse the length head's small elementwise chain; compiling a free
+    # function (not a bound method) keeps DataParallel replicas from
+    # calling a wrapper bound to replica 0, and dynamic=True avoids
+    # recompiles across the per-batch sequence lengths
+    _length_pool = torch.compile(_length_pool, dynamic=True)
 
 class LabelSmoothingLoss(_Loss):
     """
@@ -45,29 +96,31 @@ class LabelSmoothingLoss(_Loss):
         smoothing_value = label_smoothing / (tgt_vocab_size - 2)
         one_hot = torch.full((tgt_vocab_size,), smoothing_value)
         one_hot[self.ignore_index] = 0
+        # unused by the fused forward; kept so strict load_state_dict stays
+        # compatible with checkpoints saved before the cross-entropy rewrite
         self.register_buffer('one_hot', one_hot.unsqueeze(0))
+        self.label_smoothing = label_smoothing
         self.confidence = 1.0 - label_smoothing
         self.tgt_vocab_size = tgt_vocab_size
 
     def forward(self, output, target):
         """
-        output (FloatTensor): batch_size * num_pos * n_classes
+        output (FloatTensor): batch_size * num_pos * n_classes (unnormalized logits)
         target (LongTensor): batch_size * num_pos
         """
         assert self.tgt_vocab_size == output.size(2)
         batch_size, num_pos = target.size(0), target.size(1)
-        output = output.view(-1, self.tgt_vocab_size)
-        target = target.view(-1)
-        model_prob = self.one_hot.float().repeat(target.size(0), 1)
-        model_prob.scatter_(1, target.unsqueeze(1), self.confidence)
-        model_prob.masked_fill_((target == self.ignore_index).unsqueeze(1), 0)
-
-        return F.kl_div(output, model_prob, reduction='none').view(batch_size, num_pos, -1).sum(2)
+        # F.cross_entropy fuses the smoothed-target construction, log_softmax
+        # and reduction, avoiding the (B*T, V) model_prob materialization
+        return F.cross_entropy(
+            output.view(-1, self.tgt_vocab_size), target.view(-1),
+            ignore_index=self.ignore_index, label_smoothing=self.label_smoothing,
+            reduction='none').view(batch_size, num_pos)
 
 
 class MISTNAT(nn.Module):
     def __init__(self, unilm_path, use_glat=False, glat_random_prob=None, glat_f=0.5,  label_smoothing=0.1,
-                 sep_word_id=102, mask_word_id=103, pad_word_id=0, clear_bert_weight=False,):
+                 sep_word_id=102, mask_word_id=103, pad_word_id=0, clear_bert_weight=False, use_fp8=False, use_bf16=False,):
         super(MISTNAT, self).__init__()
         self.source_type_id = 0
         self.target_type_id = 1
@@ -86,13 +139,27 @@ class MISTNAT(nn.Module):
         if clear_bert_weight:
             self.bert.init_weights()
 
+        self.use_bf16 = use_bf16
+        self.use_fp8 = use_fp8
+        if use_fp8:
+            try:
+                import transformer_engine.pytorch as te
+            except ImportError:
+                raise ImportError(
+                    "use_fp8 requires TransformerEngine (pip install transformer-engine); "
+                    "it targets H100-class GPUs")
+            swap_linears_for_fp8(self.bert, te)
+            self._te = te
+
         self.config = self.bert.config
         self.config.__dict__['label_smoothing'] = label_smoothing
         self.encoder_embed_dim = self.bert.config.hidden_size
         self.embed_length = nn.Embedding(512, self.encoder_embed_dim , None)
         #init cls decoder weight with embedding
         self.cls = BertOnlyMLMHead(self.bert.config)
-        self.cls.predictions.decoder.weight = nn.Parameter(self.bert.embeddings.word_embeddings.weight.clone())
+        # tie rather than clone: the LM head shares storage (and gradients)
+        # with the input embeddings, saving a V x H parameter copy
+        self.cls.predictions.decoder.weight = self.bert.embeddings.word_embeddings.weight
 
         if self.config.label_smoothing > 0:
             self.crit_mask_lm_smoothed = LabelSmoothingLoss(
@@ -103,10 +170,24 @@ class MISTNAT(nn.Module):
             self.crit_mask_lm = nn.CrossEntropyLoss(reduction='none')
 
 
+    def bf16_autocast(self, reference):
+        # opt-in via --bf16: pre-Ampere GPUs reject bfloat16 autocast, and
+        # the apex --fp16 recipe must not be silently mixed with BF16.
+        # BF16 keeps the FP32 exponent range, so no GradScaler is needed;
+        # autocast promotes softmax/cross_entropy back to FP32 on its own
+        enabled = self.use_bf16 and reference.is_cuda and torch.cuda.is_bf16_supported()
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=enabled)
+
+    def fp8_autocast(self):
+        if self.use_fp8:
+            return self._te.fp8_autocast(enabled=True)
+        return contextlib.nullcontext()
+
+
     @staticmethod
     def create_mask_and_position_ids(num_tokens, max_len, offset=None):
-        base_position_matrix = torch.arange(
-            0, max_len, dtype=num_tokens.dtype, device=num_tokens.device).view(1, -1)
+        base_position_matrix = _base_positions(
+            max_len, num_tokens.dtype, num_tokens.device).view(1, -1)
         mask = (base_position_matrix < num_tokens.view(-1, 1)).type_as(num_tokens)
         if offset is not None:
             base_position_matrix = base_position_matrix + offset.view(-1, 1)
@@ -115,48 +196,40 @@ class MISTNAT(nn.Module):
 
     @staticmethod
     def create_attention_mask(source_mask, target_mask):
-        b = source_mask.shape[0]
         sl = source_mask.shape[1]
-        tl = target_mask.shape[1]
-        weight = torch.cat((torch.ones_like(source_mask), torch.zeros_like(target_mask)), dim=1)
-        from_weight = weight.unsqueeze(-1)
-        to_weight = weight.unsqueeze(1)
-
+        # i attends to j iff both are valid and (j is a source column or i is
+        # a target row); zeroing the source-rows/target-columns block in place
+        # replaces the weight/from_weight/to_weight construction and its four
+        # (B, L, L) intermediates
         mask = torch.cat((source_mask, target_mask), dim=1) == 1
-        mask = mask.unsqueeze(-1) & mask.unsqueeze(1)
-        # w[i][j] = f[i][0] == 1 or t[0][j] == 0
-        return (((from_weight == 0) | (to_weight == 1)) & mask).type_as(source_mask)
+        attention_mask = mask.unsqueeze(-1) & mask.unsqueeze(1)
+        attention_mask[:, :sl, sl:] = False
+        return attention_mask.type_as(source_mask)
 
 
     def forward_length(self, enc_feats, src_masks):
         # enc_feats: B x T x C
         # src_masks: B x T or None
-        enc_feats = enc_feats.transpose(0, 1)
-        src_masks = src_masks.transpose(0, 1)
-        #src_masks = (~src_masks).type_as(enc_feats)
-        src_masks = src_masks.type_as(enc_feats)
-        enc_feats = (
-            (enc_feats / src_masks.sum(0)[None, :, None]) * src_masks[:, :, None]
-        ).sum(0)
-        length_out = F.linear(enc_feats, self.embed_length.weight)
-        return F.log_softmax(length_out, -1)
+        return _length_pool(enc_feats, src_masks, self.embed_length.weight)
 
 
     def feed_bert(self, input_ids, source_mask, target_mask,
-                  token_type_ids, position_ids, target_position_ids, 
-                  target_ids=None, decoding=False):
+                  token_type_ids, position_ids, target_position_ids,
+                  target_ids=None, decoding=False, attention_mask=None):
 
-        attention_mask = self.create_attention_mask(source_mask, target_mask)
+        if attention_mask is None:
+            attention_mask = self.create_attention_mask(source_mask, target_mask)
         decoder_relative_position_mask = None
         source_len = source_mask.size(1)
 
-        outputs = self.bert(input_ids=input_ids, keep_source_unmodified=-1, attention_mask=attention_mask,
-                            token_type_ids=token_type_ids,
-                            output_hidden_states=False,
-                            position_ids=position_ids)
-        sequence_output = outputs[0]
-        pseudo_sequence_output = sequence_output[:, source_len:, ]
-        prediction_scores = self.cls(pseudo_sequence_output)
+        with self.bf16_autocast(input_ids), self.fp8_autocast():
+            outputs = self.bert(input_ids=input_ids, keep_source_unmodified=-1, attention_mask=attention_mask,
+                                token_type_ids=token_type_ids,
+                                output_hidden_states=False,
+                                position_ids=position_ids)
+            sequence_output = outputs[0]
+            pseudo_sequence_output = sequence_output[:, source_len:, ]
+            prediction_scores = self.cls(pseudo_sequence_output)
         _, prediction_tokens = prediction_scores.max(-1)
 
         prediction_tokens[~target_mask.bool()] = self.pad_word_id
@@ -204,25 +277,29 @@ class MISTNAT(nn.Module):
 
         if decoding:
             token_type_ids = torch.cat(
-                (torch.ones_like(source_ids) * self.source_type_id,
-                 torch.ones_like(pseudo_ids) * self.target_type_id), dim=1).long()
+                (torch.full_like(source_ids, self.source_type_id),
+                 torch.full_like(pseudo_ids, self.target_type_id)), dim=1).long()
 
-        mist_outputs = self.bert(
-            input_ids=new_input_ids, keep_source_unmodified=-1, attention_mask=new_attention_mask,
-            attention_masks=None, token_type_ids=token_type_ids,
-            output_hidden_states=False,
-            position_ids=new_position_ids, decoder_relative_position_mask=decoder_relative_position_mask)
+        with self.bf16_autocast(new_input_ids), self.fp8_autocast():
+            mist_outputs = self.bert(
+                input_ids=new_input_ids, keep_source_unmodified=-1, attention_mask=new_attention_mask,
+                attention_masks=None, token_type_ids=token_type_ids,
+                output_hidden_states=False,
+                position_ids=new_position_ids, decoder_relative_position_mask=decoder_relative_position_mask)
 
-        mist_sequence_output = mist_outputs['last_hidden_state']
-        mist_prediction_scores = self.cls(mist_sequence_output[:, source_len:])
+            mist_sequence_output = mist_outputs['last_hidden_state']
+            mist_prediction_scores = self.cls(mist_sequence_output[:, source_len:])
 
         return sequence_output, mist_sequence_output, prediction_scores, mist_prediction_scores
 
     def forward(self, source_ids, target_ids, pseudo_ids, num_source_tokens, num_target_tokens, decode=False):
         if decode:
             source_mask = source_ids != self.pad_word_id
-            position_ids = torch.arange(source_ids.shape[1]).repeat(source_ids.shape[0], 1).to(source_ids.device)
-            position_ids.masked_fill_(~source_mask, 0)
+            # expand is a stride-0 view, so no (B, L) copy is materialized;
+            # the masked_fill is therefore out-of-place
+            position_ids = torch.arange(
+                source_ids.shape[1], device=source_ids.device).unsqueeze(0).expand_as(source_ids)
+            position_ids = position_ids.masked_fill(~source_mask, 0)
             token_type_ids = torch.zeros_like(source_ids).to(source_ids.device)
             token_type_ids.masked_fill_(~source_mask, 1)
 
@@ -237,19 +314,17 @@ class MISTNAT(nn.Module):
             len_acc = torch.true_divide(len_acc, length_out.shape[0])
             return prediction_tokens, prediction_tokens_before, pred_length_out, len_acc, tokens_acc
 
-        if self.use_glat:
-            with torch.no_grad():
-                pseudo_ids, N = self.forward_glat(source_ids, target_ids, pseudo_ids, num_source_tokens, num_target_tokens)
         source_len = source_ids.size(1)
         target_len = target_ids.size(1)
         pseudo_len = pseudo_ids.size(1)
         assert target_len == pseudo_len
         assert source_len > 0 and target_len > 0
 
-        input_ids = torch.cat((source_ids, pseudo_ids), dim=1)
+        # token types, masks and positions only depend on the shapes and token
+        # counts, so the GLAT pass can reuse the same buffers
         token_type_ids = torch.cat(
-            (torch.ones_like(source_ids) * self.source_type_id,
-             torch.ones_like(pseudo_ids) * self.target_type_id), dim=1)
+            (torch.full_like(source_ids, self.source_type_id),
+             torch.full_like(pseudo_ids, self.target_type_id)), dim=1)
 
         source_mask, source_position_ids = \
             self.create_mask_and_position_ids(num_source_tokens, source_len)
@@ -258,15 +333,28 @@ class MISTNAT(nn.Module):
 
         position_ids = torch.cat((source_position_ids, target_position_ids), dim=1)
 
+        # the (B, L, L) attention mask is shape-only as well, so the GLAT pass
+        # and the training pass can share a single copy
+        attention_mask = self.create_attention_mask(source_mask, target_mask)
+
+        if self.use_glat:
+            with torch.no_grad():
+                pseudo_ids, N = self.forward_glat(source_ids, target_ids, pseudo_ids,
+                                                  token_type_ids, position_ids,
+                                                  source_mask, target_mask, target_position_ids,
+                                                  attention_mask=attention_mask)
+
+        input_ids = torch.cat((source_ids, pseudo_ids), dim=1)
+
         outputs = self.feed_bert(input_ids, source_mask, target_mask,
                                  token_type_ids, position_ids, target_position_ids,
-                                 target_ids=target_ids)
+                                 target_ids=target_ids, attention_mask=attention_mask)
         sequence_output, mist_sequence_output, prediction_scores, mist_prediction_scores = outputs[:4]
 
         length_tgt = target_mask.sum(-1)
-        length_out = self.forward_length(sequence_output[:, :source_len], source_mask)
-        length_loss = F.cross_entropy(length_out, length_tgt)
-        length_loss = length_loss
+        with self.bf16_autocast(sequence_output):
+            length_out = self.forward_length(sequence_output[:, :source_len], source_mask)
+        length_loss = F.cross_entropy(length_out.float(), length_tgt)
 
 
         def loss_mask_and_normalize(loss, mask):
@@ -277,12 +365,13 @@ class MISTNAT(nn.Module):
 
         pseudo_lm_losses = []
         for prediction_scores_masked in [prediction_scores, mist_prediction_scores]:
-            if self.crit_mask_lm_smoothed:
-                masked_lm_loss = self.crit_mask_lm_smoothed(
-                    F.log_softmax(prediction_scores_masked.float(), dim=-1), target_ids)
-            else:
-                masked_lm_loss = self.crit_mask_lm(
-                    prediction_scores_masked.transpose(1, 2).float(), target_ids)
+            with self.bf16_autocast(prediction_scores_masked):
+                if self.crit_mask_lm_smoothed:
+                    masked_lm_loss = self.crit_mask_lm_smoothed(
+                        prediction_scores_masked, target_ids)
+                else:
+                    masked_lm_loss = self.crit_mask_lm(
+                        prediction_scores_masked.transpose(1, 2), target_ids)
             pseudo_lm_losses.append(loss_mask_and_normalize(masked_lm_loss.float(), target_mask))
 
         pseudo_lm_loss, mist_pseudo_lm_loss = pseudo_lm_losses
@@ -292,55 +381,38 @@ class MISTNAT(nn.Module):
         else:
             return pseudo_lm_loss, mist_pseudo_lm_loss, length_loss
 
-    def forward_glat(self, source_ids, target_ids, pseudo_ids, num_source_tokens, num_target_tokens):
+    def forward_glat(self, source_ids, target_ids, pseudo_ids, token_type_ids, position_ids,
+                     source_mask, target_mask, target_position_ids, attention_mask=None):
         source_len = source_ids.size(1)
-        target_len = target_ids.size(1)
-        pseudo_len = pseudo_ids.size(1)
-        assert target_len == pseudo_len
-        assert source_len > 0 and target_len > 0
 
         input_ids = torch.cat((source_ids, pseudo_ids), dim=1)
-        token_type_ids = torch.cat(
-            (torch.ones_like(source_ids) * self.source_type_id,
-             torch.ones_like(pseudo_ids) * self.target_type_id), dim=1)
-
-        source_mask, source_position_ids = \
-            self.create_mask_and_position_ids(num_source_tokens, source_len)
-        target_mask, target_position_ids = \
-            self.create_mask_and_position_ids(num_target_tokens, target_len, offset=num_source_tokens)
-
-        #pseudo_ids.scatter_(1, (target_mask.sum(-1) - 1).view(-1, 1), self.sep_word_id)
-
-        position_ids = torch.cat((source_position_ids, target_position_ids), dim=1)
 
         outputs = self.feed_bert(input_ids, source_mask, target_mask,
-                                 token_type_ids, position_ids, target_position_ids)
+                                 token_type_ids, position_ids, target_position_ids,
+                                 attention_mask=attention_mask)
         mist_sequence_output = outputs[1]
 
         # pseudo_sequence_output = sequence_output[:, source_len:, ]
 
-        prediction_scores_masked = self.cls(mist_sequence_output[:, source_len:])
+        with self.bf16_autocast(mist_sequence_output):
+            prediction_scores_masked = self.cls(mist_sequence_output[:, source_len:])
         prediction_tokens = prediction_scores_masked.max(-1)[-1]
         N = ((prediction_tokens != target_ids) & (target_mask == 1)).sum(-1) * self.glat_f
         N = N.long()
 
-        _, indices = torch.sort(torch.rand(pseudo_ids.shape), descending=True)
-        indices = indices.to(source_ids.device)
+        # rank valid target positions by a random draw; the N[i] best-ranked
+        # positions of each row get revealed, without any per-row Python loop
+        rand = torch.rand(pseudo_ids.shape, device=pseudo_ids.device)
+        rand = rand.masked_fill(target_mask == 0, -1.)
+        ranks = rand.argsort(dim=1, descending=True).argsort(dim=1)
+        replace_mask = ranks < N.unsqueeze(1)
         if self.glat_random_prob:
-            ind_masks = torch.rand_like(indices.float()) > self.glat_random_prob
-            ind_masks.to(indices.device)
-        for i, indice in enumerate(indices):
-            indice = indice[indice < target_mask[i].sum()]
-            n = N[i].item()
-            if self.glat_random_prob:
-                ind = indice[:n]
-                ind_mask = ind_masks[i][:n]
-                pseudo_ids[i, ind[ind_mask]]  = target_ids[i, ind[ind_mask]]
-                rn = (n - ind_mask.sum()).item()
-                if rn > 0:
-                    pseudo_ids[i, ind[~ind_mask]]  = torch.randint(0, self.config.vocab_size-1, (rn,)).long().to(ind.device)
-            else:
-                pseudo_ids[i, indice[:n]] = target_ids[i, indice[:n]]
+            ind_masks = torch.rand(pseudo_ids.shape, device=pseudo_ids.device) > self.glat_random_prob
+            rand_tokens = torch.randint(0, self.config.vocab_size - 1, pseudo_ids.shape, device=pseudo_ids.device)
+            pseudo_ids = torch.where(replace_mask & ind_masks, target_ids, pseudo_ids)
+            pseudo_ids = torch.where(replace_mask & ~ind_masks, rand_tokens, pseudo_ids)
+        else:
+            pseudo_ids = torch.where(replace_mask, target_ids, pseudo_ids)
 
         return pseudo_ids, N
 
@@ -359,26 +431,34 @@ class MISTNAT(nn.Module):
             to_weight = weight.unsqueeze(1)
             attention_mask = ((from_weight > 0) & (to_weight > 0)).bool()
 
-            outputs = self.bert(input_ids, token_type_ids=token_type_ids, attention_mask=attention_mask,
-                                        position_ids=position_ids, output_hidden_states=False)
+            # the length pass is pure inference (only its argmax is kept for
+            # sizing), so skip autograd tracking entirely; the clamps stay
+            # inside because inference tensors reject in-place updates outside
+            with torch.inference_mode(), self.bf16_autocast(input_ids), self.fp8_autocast():
+                outputs = self.bert(input_ids, token_type_ids=token_type_ids, attention_mask=attention_mask,
+                                            position_ids=position_ids, output_hidden_states=False)
 
-            sequence_output = outputs['last_hidden_state']
+                sequence_output = outputs['last_hidden_state']
 
-            length_out = self.forward_length(sequence_output, source_mask)
-            length_out = length_out.max(-1)[1]
-            length_out[length_out > 48] = 48
-            length_out[length_out < 7] = 7
+                length_out = self.forward_length(sequence_output, source_mask)
+                length_out = length_out.max(-1)[1]
+                length_out[length_out > 48] = 48
+                length_out[length_out < 7] = 7
         else:
             length_out += 1
+            length_out[length_out > 48] = 48
 
-        target_len = length_out.max().item()
+        # length_out is capped at 48 above, so the allocation size is static
+        # and the blocking length_out.max().item() sync disappears
+        target_len = 48
         if target_len + source_len > 512:
             source_len = 512-target_len
             source_ids = source_ids[:, :source_len]
             source_position_ids = source_position_ids[:, :source_len]
             source_mask = source_mask[:, :source_len]
 
-        pseudo_ids = torch.empty(length_out.shape[0], target_len).fill_(self.mask_word_id).to(input_ids.device)
+        pseudo_ids = torch.full((length_out.shape[0], target_len), self.mask_word_id,
+                                dtype=input_ids.dtype, device=input_ids.device)
         base_position_matrix = torch.arange(target_len, dtype=input_ids.dtype,
                                             device=input_ids.device).view(1, -1)
 
@@ -392,8 +472,8 @@ class MISTNAT(nn.Module):
 
         position_ids = torch.cat((source_position_ids, pseudo_position_ids), dim=1)
         token_type_ids = torch.cat(
-            (torch.ones_like(source_ids) * self.source_type_id,
-             torch.ones_like(pseudo_ids) * self.target_type_id), dim=1).long()
+            (torch.full_like(source_ids, self.source_type_id),
+             torch.full_like(pseudo_ids, self.target_type_id)), dim=1).long()
 
         outputs = self.feed_bert(input_ids, source_mask, pseudo_mask,
                                 token_type_ids, position_ids, pseudo_position_ids,
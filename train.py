@@ -41,6 +41,22 @@ MODEL_CLASSES = {
 }
 
 
+class GraphedTrainStep(torch.nn.Module):
+    """Training-only callable for CUDA Graph capture.
+
+    Graphing this wrapper instead of the model keeps model.forward (and its
+    decode=True path used by valid()) unpatched, and pins the graphed
+    signature to the five positional training tensors.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, source_ids, target_ids, pseudo_ids, num_source_tokens, num_target_tokens):
+        return self.model(source_ids, target_ids, pseudo_ids, num_source_tokens, num_target_tokens)
+
+
 def remove_repeat(l):
     out = []
     for i in l.split():
@@ -49,6 +65,19 @@ def remove_repeat(l):
         out.append(i)
     return ' '.join(out)
 
+def untie_lm_head_if_needed(model, state_dict):
+    # the LM head is tied to the input embeddings, so both keys load into the
+    # same storage; a checkpoint saved with untied (divergent) weights would
+    # silently have its embeddings overwritten by the decoder matrix
+    emb_key = 'bert.embeddings.word_embeddings.weight'
+    dec_key = 'cls.predictions.decoder.weight'
+    if emb_key in state_dict and dec_key in state_dict \
+            and not torch.equal(state_dict[emb_key], state_dict[dec_key]):
+        logger.warning(
+            'checkpoint has untied LM head weights; untying the model before loading')
+        model.cls.predictions.decoder.weight = torch.nn.Parameter(
+            state_dict[dec_key].clone())
+
 def prepare_for_training(args, model, checkpoint_state_dict, amp):
     no_decay = ['bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
@@ -306,6 +335,17 @@ def train(args, training_features, valid_features, model, tokenizer):
 
         tr_loss, logging_loss = 0.0, 0.0
 
+        # CUDA Graph capture only makes sense for the plain single-GPU loop:
+        # apex rewrites the backward and DataParallel/DDP scatter the batch.
+        # The MIST co-train path is excluded too: MISTNAT.feed_bert runs a
+        # per-example Python loop with data-dependent host syncs and pageable
+        # host->device copies, which are illegal during stream capture
+        use_cuda_graph = (args.cuda_graph and torch.cuda.is_available()
+                          and not args.fp16 and args.n_gpu <= 1 and args.local_rank == -1
+                          and args.gradient_accumulation_steps == 1
+                          and not args.cotrain_put_target_in_source)
+        graphed_step = None
+
         for step, batch in enumerate(train_iterator):
 
             model.train()
@@ -317,8 +357,21 @@ def train(args, training_features, valid_features, model, tokenizer):
                         'num_source_tokens': batch[3],
                         'num_target_tokens': batch[4]}
 
+            if use_cuda_graph and graphed_step is None and step >= args.cuda_graph_warmup_steps:
+                # Seq2seqDatasetForBert pads every example to the static
+                # max_source/target lengths, so once the eager warmup steps have
+                # settled the allocator and autotuner, the whole forward+backward
+                # can be captured once and replayed with input copies only.
+                # allow_unused_input: the pooler parameters receive no gradient
+                # from pseudo_lm_loss + length_loss
+                graphed_step = torch.cuda.make_graphed_callables(
+                    GraphedTrainStep(model), tuple(batch), allow_unused_input=True)
+
             # loss = model(**inputs)
-            outputs = model(**inputs)
+            if graphed_step is not None:
+                outputs = graphed_step(*batch)
+            else:
+                outputs = model(**inputs)
             if args.cotrain_put_target_in_source:
                 pseudo_lm_loss, mist_pseudo_lm_loss, length_loss = outputs[:3]
             else:
@@ -524,6 +577,9 @@ def get_args():
                         help="local_rank for distributed training on gpus")
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Run the BERT forward and heads under bfloat16 autocast (Ampere+ GPUs); "
+                             "not combinable with --fp16")
     parser.add_argument('--fp16_opt_level', type=str, default='O1',
                         help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
                              "See details at https://nvidia.github.io/apex/amp.html")
@@ -531,6 +587,15 @@ def get_args():
     parser.add_argument('--server_port', type=str, default='', help="Can be used for distant debugging.")
 
 
+    parser.add_argument("--use_fp8", action='store_true',
+                        help="Run the BERT linears in FP8 via TransformerEngine (H100-class GPUs)")
+
+    parser.add_argument("--cuda_graph", action='store_true',
+                        help="Capture the steady-state training step with CUDA Graphs "
+                             "(single GPU, no fp16/gradient accumulation)")
+    parser.add_argument("--cuda_graph_warmup_steps", type=int, default=11,
+                        help="Eager steps to run before capturing the CUDA Graph")
+
     parser.add_argument("--use_glat", action='store_true',
                         help="Whether not to use glat")
     parser.add_argument("--glat_f", type=float, default=0.5)
@@ -570,6 +635,9 @@ def get_args():
 
 
 def prepare(args):
+    if args.bf16 and args.fp16:
+        raise ValueError("--bf16 cannot be combined with --fp16 (apex); pick one precision recipe")
+
     # Setup distant debugging if needed
     if args.server_ip and args.server_port:
         # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -627,12 +695,14 @@ def nat_get_model_and_tokenizer(args):
         from model_mist import MISTNAT
         model = MISTNAT(args.model_name_or_path, use_glat=args.use_glat, glat_f=args.glat_f, label_smoothing=args.label_smoothing,
                         sep_word_id=tokenizer.sep_token_id, pad_word_id=tokenizer.pad_token_id,
-                        mask_word_id=tokenizer.mask_token_id, clear_bert_weight=args.clear_bert_weight)
+                        mask_word_id=tokenizer.mask_token_id, clear_bert_weight=args.clear_bert_weight,
+                        use_fp8=args.use_fp8, use_bf16=args.bf16)
     else:
         from model import NAT
         model = NAT(args.model_name_or_path, use_glat=args.use_glat, glat_f=args.glat_f, label_smoothing=args.label_smoothing,
                         sep_word_id=tokenizer.sep_token_id, pad_word_id=tokenizer.pad_token_id,
-                        mask_word_id=tokenizer.mask_token_id, clear_bert_weight=args.clear_bert_weight)
+                        mask_word_id=tokenizer.mask_token_id, clear_bert_weight=args.clear_bert_weight,
+                        use_fp8=args.use_fp8, use_bf16=args.bf16)
     return model, tokenizer
 
 def main():
@@ -708,6 +778,7 @@ def main():
                     name = name.replace('bert_decoder', 'bert').replace('bert_encoder', 'bert')
 
                 new_state_dict[name] = v
+            untie_lm_head_if_needed(model, new_state_dict)
             model.load_state_dict(new_state_dict)
         #if args.fp16:
             #model.half()
@@ -744,6 +815,7 @@ def main():
             for k, v in state_dict.items():
                 name = k[7:] # remove `module.`
                 new_state_dict[name] = v
+            untie_lm_head_if_needed(model, new_state_dict)
             model.load_state_dict(new_state_dict)
         train(args, training_features, validing_features, model, tokenizer)
 